@@ -1,13 +1,18 @@
 # main.py
 import os
 import re
+import math
+import sqlite3
 import asyncio
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 from dotenv import load_dotenv
 import aiosqlite
+import orjson
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
 from aiogram.filters.state import StateFilter
 from aiogram.fsm.context import FSMContext
@@ -22,10 +27,17 @@ if not API_TOKEN:
     raise RuntimeError("BOT_TOKEN не знайдено в змінних оточення. Додайте BOT_TOKEN у .env або в оточення сервера.")
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "db.sqlite3")
+DB: Optional[aiosqlite.Connection] = None  # спільне з'єднання, відкривається в main()
+# Транзакція в спільного з'єднання одна на всіх: кожен запис (execute + commit)
+# іде під цим локом, щоб не закомітити/відкотити чужий незавершений запис.
+# Створюється в main(): на Python 3.9 Lock/Queue прив'язуються до циклу при створенні.
+DB_WRITE_LOCK: Optional[asyncio.Lock] = None
 
 # --- Bot & Dispatcher
 storage = MemoryStorage()
-bot = Bot(token=API_TOKEN)
+# orjson замість stdlib json для (де)серіалізації запитів до Bot API
+session = AiohttpSession(json_loads=orjson.loads, json_dumps=lambda o: orjson.dumps(o).decode())
+bot = Bot(token=API_TOKEN, session=session)
 dp = Dispatcher(storage=storage)
 
 # --- Клавіатура (reply)
@@ -39,6 +51,26 @@ main_keyboard = types.ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
+# --- Inline-клавіатури (статичні, будуються один раз)
+exp_type_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Паливо", callback_data="exp_type:fuel"),
+     types.InlineKeyboardButton(text="Мийка", callback_data="exp_type:wash")],
+    [types.InlineKeyboardButton(text="Ремонт", callback_data="exp_type:repair"),
+     types.InlineKeyboardButton(text="Інше", callback_data="exp_type:other")]
+])
+
+car_edit_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Редагувати ім'я", callback_data="edit:name")],
+    [types.InlineKeyboardButton(text="Редагувати авто", callback_data="edit:car")],
+    [types.InlineKeyboardButton(text="Закрити", callback_data="edit:close")]
+])
+
+settings_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="Мова: Українська", callback_data="setlang:uk")],
+    [types.InlineKeyboardButton(text="Період звітів: Щотижня", callback_data="setperiod:weekly"),
+     types.InlineKeyboardButton(text="Період звітів: Щомісяця", callback_data="setperiod:monthly")],
+])
+
 # --- Станова машина для реєстрації + додавання фінансів
 class Registration(StatesGroup):
     waiting_for_name = State()
@@ -53,113 +85,306 @@ class AddExpense(StatesGroup):
     waiting_for_amount = State()
     waiting_for_type = State()
 
+class Report(StatesGroup):
+    waiting_for_range = State()
+
 # --- Паттерни та допоміжні функції
-PLATE_RE = re.compile(r'^[A-ZА-Я]{2}\d{4}[A-ZА-Я]{2}$', re.I)  # дозволяє лат/київські літери
+PLATE_RE = re.compile(r'[A-ZА-Я]{2}\d{4}[A-ZА-Я]{2}')  # дозволяє лат/київські літери; ввід уже в upper()
+DATE_RANGE_RE = re.compile(r'^\s*\d{4}-\d{2}-\d{2}\s*,\s*\d{4}-\d{2}-\d{2}\s*$')
 def normalize_plate(text: str) -> str:
     return text.strip().upper().replace(" ", "")
 
-def is_valid_money(text: str) -> bool:
+def try_money(text: Optional[str]) -> Optional[float]:
+    # None для нетекстових повідомлень, нечислового вводу та сум <= 0
+    if text is None:
+        return None
     try:
         v = float(text.replace(",", "."))
-        return v > 0
-    except:
-        return False
-
-def parse_money(text: str) -> float:
-    return float(text.replace(",", "."))
+    except ValueError:
+        return None
+    return v if v > 0 and math.isfinite(v) else None
 
 # --- Ініціалізація та запити до БД ---
+async def apply_pragmas(db: aiosqlite.Connection):
+    # WAL + synchronous=NORMAL: коміт = дописування в WAL без повного fsync журналу
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA cache_size=-64000")
+    await db.execute("PRAGMA mmap_size=268435456")
+    await db.execute("PRAGMA foreign_keys=ON")
+
+SCHEMA_VERSION = 3  # 1: ts / registered_at як INTEGER (unix-секунди, UTC); 2: DEFAULT для ts; 3: UNIQUE LOWER(nickname)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    tg_first_name TEXT,
+    name TEXT,
+    nickname TEXT UNIQUE,
+    car_model TEXT,
+    car_number TEXT,
+    lang TEXT DEFAULT 'uk',
+    report_period TEXT DEFAULT 'weekly',
+    registered_at INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS incomes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    amount REAL,
+    ts INTEGER DEFAULT (CAST(strftime('%s','now') AS INTEGER)),
+    note TEXT,
+    FOREIGN KEY(user_id) REFERENCES users(user_id)
+);
+
+CREATE TABLE IF NOT EXISTS expenses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    amount REAL,
+    type TEXT,
+    ts INTEGER DEFAULT (CAST(strftime('%s','now') AS INTEGER)),
+    note TEXT,
+    FOREIGN KEY(user_id) REFERENCES users(user_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_inc_uid_ts ON incomes(user_id, ts);
+CREATE INDEX IF NOT EXISTS ix_exp_uid_ts ON expenses(user_id, ts);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_users_nick_lower ON users(LOWER(nickname));
+"""
+
+# Тип і DEFAULT колонки в SQLite не змінити через ALTER, тому старі таблиці
+# перебудовуються під SCHEMA. {ts}/{registered_at} — вирази для копіювання
+# значень: у версії 0 це ISO-рядки, з версії 1 — вже unix-секунди.
+REBUILD_TABLES = """
+BEGIN;
+DROP INDEX IF EXISTS ix_inc_uid_ts;
+DROP INDEX IF EXISTS ix_exp_uid_ts;
+DROP INDEX IF EXISTS ix_users_nick_lower;
+DROP INDEX IF EXISTS ux_users_nick_lower;
+ALTER TABLE users RENAME TO users_old;
+ALTER TABLE incomes RENAME TO incomes_old;
+ALTER TABLE expenses RENAME TO expenses_old;
+""" + SCHEMA + """
+INSERT INTO users
+    SELECT user_id, tg_first_name, name, nickname, car_model, car_number, lang, report_period,
+           {registered_at}
+    FROM users_old;
+INSERT INTO incomes
+    SELECT id, user_id, amount, {ts}, note FROM incomes_old;
+INSERT INTO expenses
+    SELECT id, user_id, amount, type, {ts}, note FROM expenses_old;
+DROP TABLE incomes_old;
+DROP TABLE expenses_old;
+DROP TABLE users_old;
+PRAGMA user_version = """ + str(SCHEMA_VERSION) + """;
+COMMIT;
+"""
+ISO_TO_TS = "CAST(strftime('%s', {}) AS INTEGER)"
+
 async def init_db():
+    # save_user використовує RETURNING і кілька ON CONFLICT — це SQLite 3.35+
+    if sqlite3.sqlite_version_info < (3, 35):
+        raise RuntimeError(f"Потрібен SQLite 3.35 або новіший, знайдено {sqlite3.sqlite_version}. Оновіть Python/SQLite на сервері.")
     async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            tg_first_name TEXT,
-            name TEXT,
-            nickname TEXT UNIQUE,
-            car_model TEXT,
-            car_number TEXT,
-            lang TEXT DEFAULT 'uk',
-            report_period TEXT DEFAULT 'weekly',
-            registered_at TEXT
-        );
-
-        CREATE TABLE IF NOT EXISTS incomes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            amount REAL,
-            ts TEXT,
-            note TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        );
-
-        CREATE TABLE IF NOT EXISTS expenses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            amount REAL,
-            type TEXT,
-            ts TEXT,
-            note TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        );
-        """)
+        await apply_pragmas(db)
+        cur = await db.execute("PRAGMA user_version")
+        version = (await cur.fetchone())[0]
+        cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users'")
+        has_tables = await cur.fetchone() is not None
+        if has_tables and version < 3:
+            # до версії 3 псевдоніми перевірялись окремим SELECT перед вставкою, тож
+            # гонка могла лишити "Bob" і "bob" — з ними UNIQUE-індекс не створиться
+            cur = await db.execute(
+                "SELECT LOWER(nickname) FROM users WHERE nickname IS NOT NULL GROUP BY 1 HAVING COUNT(*)>1")
+            dupes = [r[0] for r in await cur.fetchall()]
+            if dupes:
+                raise RuntimeError(
+                    "Псевдоніми, що відрізняються лише регістром, зустрічаються в users більше одного разу: "
+                    + ", ".join(dupes) + ". Перейменуйте їх вручну в " + DB_PATH + " і запустіть бота знову.")
+        if has_tables and version < 2:
+            if version < 1:
+                script = REBUILD_TABLES.format(ts=ISO_TO_TS.format("ts"), registered_at=ISO_TO_TS.format("registered_at"))
+            else:
+                script = REBUILD_TABLES.format(ts="ts", registered_at="registered_at")
+            # перебудова таблиць можлива лише з вимкненими FK
+            await db.execute("PRAGMA foreign_keys=OFF")
+            try:
+                await db.executescript(script)
+            except sqlite3.Error:
+                # скрипт відкриває BEGIN сам — не лишаємо транзакцію висіти
+                await db.rollback()
+                raise
+            await db.execute("PRAGMA foreign_keys=ON")
+        elif has_tables and version < 3:
+            # звичайний індекс замінюється унікальним (створює SCHEMA)
+            await db.execute("DROP INDEX IF EXISTS ix_users_nick_lower")
+        await db.executescript(SCHEMA)
+        await db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
         await db.commit()
 
+# ts зберігається як unix-секунди; naive datetime вважаємо UTC
+def to_ts(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+DAY_SECONDS = 24 * 60 * 60
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
 async def fetchone(query, params=()):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(query, params)
-        row = await cur.fetchone()
-        return row
+    cur = await DB.execute(query, params)
+    row = await cur.fetchone()
+    return row
 
 async def execute(query, params=()):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(query, params)
-        await db.commit()
+    async with DB_WRITE_LOCK:
+        await DB.execute(query, params)
+        await DB.commit()
+
+# --- Черга записів: вставки доходів/витрат збираються в пачки ---
+# Хендлер лише кладе (query, params) у чергу й одразу відповідає; фоновий
+# writer_loop за один коміт (один fsync у WAL) пише до WRITE_BATCH_MAX рядків,
+# що надійшли протягом WRITE_BATCH_WINDOW секунд.
+WRITE_Q: Optional[asyncio.Queue] = None  # створюється в main()
+WRITE_BATCH_MAX = 200
+WRITE_BATCH_WINDOW = 0.02
+
+async def enqueue_write(query, params=()):
+    await WRITE_Q.put((query, params))
+
+async def writer_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await WRITE_Q.get()]
+        deadline = loop.time() + WRITE_BATCH_WINDOW
+        while len(batch) < WRITE_BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(WRITE_Q.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await write_batch(batch)
+        finally:
+            for _ in batch:
+                WRITE_Q.task_done()
+
+async def write_batch(batch):
+    by_query = {}
+    for query, params in batch:
+        by_query.setdefault(query, []).append(params)
+    async with DB_WRITE_LOCK:
+        # savepoint відкочує лише частково вставлену пачку, а не всю транзакцію
+        await DB.execute("SAVEPOINT write_batch")
+        try:
+            for query, rows in by_query.items():
+                await DB.executemany(query, rows)
+        except sqlite3.Error:
+            # пачка не пройшла — пишемо по рядку, щоб втратити лише зіпсований
+            logging.warning("Пачка з %d рядків не записалась, пишемо по одному", len(batch))
+            await DB.execute("ROLLBACK TO write_batch")
+            for query, params in batch:
+                try:
+                    await DB.execute(query, params)
+                except sqlite3.Error as e:
+                    logging.error("Не вдалося записати рядок %r: %s", params, e)
+        await DB.commit()
+
+def on_writer_done(task: asyncio.Task):
+    # writer_loop нескінченний: якщо він завершився не через cancel(), записи
+    # більше не зберігаються — логуємо й зупиняємо бота
+    if task.cancelled():
+        return
+    logging.error("writer_loop зупинився, бот зупиняється", exc_info=task.exception())
+    asyncio.ensure_future(dp.stop_polling())
 
 # --- Юзер-функції ---
-async def user_exists(user_id: int) -> bool:
-    r = await fetchone("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-    return r is not None
+# Реєстрація одноразова, тож user_id зареєстрованих тримаємо в пам'яті:
+# заповнюється в load_registered() при старті й поповнюється в save_user()
+REGISTERED: set[int] = set()
 
-async def save_user(user_id: int, tg_first_name: str, data: dict):
-    now = datetime.utcnow().isoformat()
-    await execute("""
-        INSERT OR REPLACE INTO users (user_id, tg_first_name, name, nickname, car_model, car_number, registered_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (user_id, tg_first_name, data.get("name"), data.get("nickname"), data.get("car_model"), data.get("car_number"), now))
+async def load_registered():
+    cur = await DB.execute("SELECT user_id FROM users")
+    REGISTERED.update(r[0] for r in await cur.fetchall())
 
-async def nickname_exists(nickname: str) -> bool:
-    r = await fetchone("SELECT 1 FROM users WHERE LOWER(nickname)=LOWER(?)", (nickname,))
-    return r is not None
+async def user_exists(user_id: int) -> bool:
+    return user_id in REGISTERED
+
+async def save_user(user_id: int, tg_first_name: str, data: dict) -> bool:
+    # Перевірка псевдоніма й вставка — один атомарний запит: False, якщо
+    # псевдонім (без урахування регістру) вже зайнятий іншим водієм
+    now = to_ts(utcnow())
+    async with DB_WRITE_LOCK:
+        try:
+            cur = await DB.execute("""
+                INSERT INTO users (user_id, tg_first_name, name, nickname, car_model, car_number, registered_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    tg_first_name=excluded.tg_first_name, name=excluded.name, nickname=excluded.nickname,
+                    car_model=excluded.car_model, car_number=excluded.car_number, registered_at=excluded.registered_at
+                ON CONFLICT DO NOTHING
+                RETURNING user_id
+            """, (user_id, tg_first_name, data.get("name"), data.get("nickname"), data.get("car_model"), data.get("car_number"), now))
+            saved = bool(await cur.fetchall())
+        except sqlite3.IntegrityError:
+            # DO UPDATE для вже зареєстрованого водія на чужий псевдонім
+            saved = False
+        await DB.commit()
+    if saved:
+        REGISTERED.add(user_id)
+    return saved
 
 # --- Баланс і статистика ---
-async def get_balance(user_id:int, since: datetime=None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        if since:
-            ts = since.isoformat()
-            cur_in = await db.execute("SELECT COALESCE(SUM(amount),0) FROM incomes WHERE user_id=? AND ts>=?", (user_id, ts))
-            cur_ex = await db.execute("SELECT COALESCE(SUM(amount),0) FROM expenses WHERE user_id=? AND ts>=?", (user_id, ts))
-        else:
-            cur_in = await db.execute("SELECT COALESCE(SUM(amount),0) FROM incomes WHERE user_id=?", (user_id,))
-            cur_ex = await db.execute("SELECT COALESCE(SUM(amount),0) FROM expenses WHERE user_id=?", (user_id,))
-        total_in = (await cur_in.fetchone())[0] or 0.0
-        total_ex = (await cur_ex.fetchone())[0] or 0.0
-        return total_in, total_ex, total_in - total_ex
+# Суми доходів і витрат за день/тиждень/місяць/весь час одним запитом:
+# обидві таблиці зводяться в UNION ALL з ознакою kind, кожна гілка — пошук
+# по індексу (user_id, ts); результат — вісім сум одним рядком
+STATS_SQL = """
+    SELECT SUM(CASE WHEN kind=1 AND ts>=?1 THEN amount ELSE 0 END),
+           SUM(CASE WHEN kind=1 AND ts>=?2 THEN amount ELSE 0 END),
+           SUM(CASE WHEN kind=1 AND ts>=?3 THEN amount ELSE 0 END),
+           SUM(CASE WHEN kind=1 THEN amount ELSE 0 END),
+           SUM(CASE WHEN kind=-1 AND ts>=?1 THEN amount ELSE 0 END),
+           SUM(CASE WHEN kind=-1 AND ts>=?2 THEN amount ELSE 0 END),
+           SUM(CASE WHEN kind=-1 AND ts>=?3 THEN amount ELSE 0 END),
+           SUM(CASE WHEN kind=-1 THEN amount ELSE 0 END)
+    FROM (
+        SELECT 1 AS kind, ts, amount FROM incomes WHERE user_id=?4
+        UNION ALL
+        SELECT -1, ts, amount FROM expenses WHERE user_id=?4
+    )
+"""
+
+# межі періодів — unix-секунди (див. to_ts), без конвертацій всередині
+async def get_stats(user_id: int, day_from: int, week_from: int, month_from: int):
+    params = (day_from, week_from, month_from, user_id)
+    row = await fetchone(STATS_SQL, params)
+    inc, exp = row[:4], row[4:]
+    # [(дохід, витрата, баланс)] для day, week, month, total
+    return [(i or 0.0, e or 0.0, (i or 0.0) - (e or 0.0)) for i, e in zip(inc, exp)]
 
 # --- Рейтинги ---
 async def get_top_drivers(limit=10):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT u.nickname, u.name, COALESCE(SUM(i.amount),0) - COALESCE(SUM(e.amount),0) AS balance
-            FROM users u
-            LEFT JOIN incomes i ON i.user_id = u.user_id
-            LEFT JOIN expenses e ON e.user_id = u.user_id
-            GROUP BY u.user_id
-            ORDER BY balance DESC
-            LIMIT ?
-        """, (limit,))
-        rows = await cur.fetchall()
-        return rows
+    # доходи і витрати зводимо в один потік через UNION ALL, щоб LEFT JOIN
+    # двох таблиць не перемножував рядки (I*E) і не завищував суми
+    cur = await DB.execute("""
+        SELECT u.nickname, u.name, COALESCE(SUM(t.sign * t.amount),0) AS balance
+        FROM users u
+        LEFT JOIN (
+            SELECT user_id, amount, 1 AS sign FROM incomes
+            UNION ALL
+            SELECT user_id, amount, -1 FROM expenses
+        ) t ON t.user_id = u.user_id
+        GROUP BY u.user_id
+        ORDER BY balance DESC
+        LIMIT ?
+    """, (limit,))
+    rows = await cur.fetchall()
+    return rows
 
 # --- Обробники: реєстрація / старт ---
 async def cmd_start(message: types.Message, state: FSMContext):
@@ -178,10 +403,11 @@ async def process_name(message: types.Message, state: FSMContext):
 
 async def process_nickname(message: types.Message, state: FSMContext):
     nick = message.text.strip()
-    if await nickname_exists(nick):
-        await message.answer("Цей псевдонім вже зайнятий. Оберіть інший:")
-        return
     await state.update_data(nickname=nick)
+    if "car_number" in await state.get_data():
+        # повторний ввід після зайнятого псевдоніма: решта даних уже є
+        await finish_registration(message, state)
+        return
     await message.answer("Вкажіть марку та модель авто (наприклад Renault Logan):")
     await state.set_state(Registration.waiting_for_car_model)
 
@@ -192,12 +418,18 @@ async def process_car_model(message: types.Message, state: FSMContext):
 
 async def process_car_number(message: types.Message, state: FSMContext):
     plate = normalize_plate(message.text)
-    if not PLATE_RE.match(plate):
+    if not PLATE_RE.fullmatch(plate):
         await message.answer("Невірний формат номера. Спробуйте у форматі BC1234AB (без пробілів).")
         return
     await state.update_data(car_number=plate)
+    await finish_registration(message, state)
+
+async def finish_registration(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    await save_user(message.from_user.id, message.from_user.first_name, data)
+    if not await save_user(message.from_user.id, message.from_user.first_name, data):
+        await message.answer("Цей псевдонім вже зайнятий. Оберіть інший:")
+        await state.set_state(Registration.waiting_for_nickname)
+        return
     await message.answer("✅ Реєстрацію завершено!", reply_markup=main_keyboard)
     await state.clear()
 
@@ -210,12 +442,11 @@ async def add_income_start(message: types.Message, state: FSMContext):
     await state.set_state(AddIncome.waiting_for_amount)
 
 async def add_income_amount(message: types.Message, state: FSMContext):
-    if not is_valid_money(message.text):
+    amount = try_money(message.text)
+    if amount is None:
         await message.answer("Некоректна сума. Введіть число > 0.")
         return
-    amount = parse_money(message.text)
-    ts = datetime.utcnow().isoformat()
-    await execute("INSERT INTO incomes (user_id, amount, ts, note) VALUES (?, ?, ?, ?)", (message.from_user.id, amount, ts, None))
+    await enqueue_write("INSERT INTO incomes (user_id, amount, note) VALUES (?, ?, ?)", (message.from_user.id, amount, None))
     await message.answer(f"Додано до доходів: {amount:.2f}", reply_markup=main_keyboard)
     await state.clear()
 
@@ -227,18 +458,13 @@ async def add_expense_start(message: types.Message, state: FSMContext):
     await state.set_state(AddExpense.waiting_for_amount)
 
 async def add_expense_amount(message: types.Message, state: FSMContext):
-    if not is_valid_money(message.text):
+    amount = try_money(message.text)
+    if amount is None:
         await message.answer("Некоректна сума. Введіть число > 0.")
         return
-    await state.update_data(exp_amount=parse_money(message.text))
+    await state.update_data(exp_amount=amount)
     # показуємо варіанти типів витрат inline
-    kb = types.InlineKeyboardMarkup(inline_keyboard=[
-        [types.InlineKeyboardButton(text="Паливо", callback_data="exp_type:fuel"),
-         types.InlineKeyboardButton(text="Мийка", callback_data="exp_type:wash")],
-        [types.InlineKeyboardButton(text="Ремонт", callback_data="exp_type:repair"),
-         types.InlineKeyboardButton(text="Інше", callback_data="exp_type:other")]
-    ])
-    await message.answer("Оберіть тип витрати:", reply_markup=kb)
+    await message.answer("Оберіть тип витрати:", reply_markup=exp_type_keyboard)
     await state.set_state(AddExpense.waiting_for_type)
 
 async def exp_type_callback(callback: types.CallbackQuery, state: FSMContext):
@@ -250,9 +476,8 @@ async def exp_type_callback(callback: types.CallbackQuery, state: FSMContext):
         await state.clear()
         return
     _, type_cb = callback.data.split(":", 1)
-    ts = datetime.utcnow().isoformat()
-    await execute("INSERT INTO expenses (user_id, amount, type, ts, note) VALUES (?, ?, ?, ?, ?)",
-                  (callback.from_user.id, amount, type_cb, ts, None))
+    await enqueue_write("INSERT INTO expenses (user_id, amount, type, note) VALUES (?, ?, ?, ?)",
+                        (callback.from_user.id, amount, type_cb, None))
     await callback.message.answer(f"Додано витрату {amount:.2f} ({type_cb})", reply_markup=main_keyboard)
     await state.clear()
 
@@ -262,14 +487,12 @@ async def my_stats_handler(message: types.Message, state: FSMContext):
     if not await user_exists(uid):
         await message.answer("Ви не зареєстровані. Надішліть /start щоб зареєструватися.")
         return
-    now = datetime.utcnow()
-    day_from = now - timedelta(days=1)
-    week_from = now - timedelta(days=7)
-    month_from = now - timedelta(days=30)
-    din, dex, dbal = await get_balance(uid, since=day_from)
-    win, wex, wbal = await get_balance(uid, since=week_from)
-    minc, mexp, mbal = await get_balance(uid, since=month_from)
-    total_in, total_ex, total_balance = await get_balance(uid, since=None)
+    now = to_ts(utcnow())
+    day_from = now - DAY_SECONDS
+    week_from = now - 7 * DAY_SECONDS
+    month_from = now - 30 * DAY_SECONDS
+    (din, dex, dbal), (win, wex, wbal), (minc, mexp, mbal), (total_in, total_ex, total_balance) = \
+        await get_stats(uid, day_from, week_from, month_from)
     text = (
         f"Баланс загальний: {total_balance:.2f}\n"
         f"Сьогодні: +{din:.2f} -{dex:.2f} = {dbal:.2f}\n"
@@ -280,18 +503,20 @@ async def my_stats_handler(message: types.Message, state: FSMContext):
 
 # --- Звіт за період: запит дат (простота: YYYY-MM-DD) ---
 async def report_period_start(message: types.Message, state: FSMContext):
-    await message.answer("Введіть початкову дату у форматі YYYY-MM-DD:")
-    await state.set_state(State().set_state)  # тимчасово використовуємо загальний стан
-    # але краще реалізувати окрему StatesGroup для звітів. Для стислості нижче — простий підхід.
-
-# Додатково — спростимо: обробник з regex на дату
+    await message.answer("Введіть період у форматі YYYY-MM-DD,YYYY-MM-DD (наприклад 2025-01-01,2025-01-31):")
+    await state.set_state(Report.waiting_for_range)
+
+REPORT_ROWS_LIMIT = 50  # рядків на розділ: повідомлення Telegram обмежене 4096 символами
+REPORT_INC_TOTAL_SQL = "SELECT COALESCE(SUM(amount),0), COUNT(*) FROM incomes WHERE user_id=? AND ts>=? AND ts<?"
+REPORT_EXP_TOTAL_SQL = "SELECT COALESCE(SUM(amount),0), COUNT(*) FROM expenses WHERE user_id=? AND ts>=? AND ts<?"
+REPORT_INC_ROWS_SQL = "SELECT date(ts,'unixepoch'),amount FROM incomes WHERE user_id=? AND ts>=? AND ts<? ORDER BY ts LIMIT ?"
+REPORT_EXP_ROWS_SQL = "SELECT date(ts,'unixepoch'),amount,type FROM expenses WHERE user_id=? AND ts>=? AND ts<? ORDER BY ts LIMIT ?"
 async def report_period_handler(message: types.Message, state: FSMContext):
-    # очікуємо два рядки: start,end або формат обробки послідовно — тут для простої UX попросимо ввести як "YYYY-MM-DD,YYYY-MM-DD"
-    txt = message.text.strip()
-    parts = [p.strip() for p in txt.split(",") if p.strip()]
-    if len(parts) != 2:
+    # очікуємо один рядок "YYYY-MM-DD,YYYY-MM-DD"; до коректного вводу лишаємось у Report.waiting_for_range
+    if message.text is None or not DATE_RANGE_RE.match(message.text):
         await message.answer("Невірний формат. Надішліть у вигляді: 2025-01-01,2025-01-31")
         return
+    parts = [p.strip() for p in message.text.split(",")]
     try:
         start = datetime.fromisoformat(parts[0])
         end = datetime.fromisoformat(parts[1]) + timedelta(days=1)
@@ -299,36 +524,38 @@ async def report_period_handler(message: types.Message, state: FSMContext):
         await message.answer("Невірний формат дат. Спробуйте ще раз.")
         return
     uid = message.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur_i = await db.execute("SELECT ts,amount FROM incomes WHERE user_id=? AND ts>=? AND ts<? ORDER BY ts", (uid, start.isoformat(), end.isoformat()))
-        incomes = await cur_i.fetchall()
-        cur_e = await db.execute("SELECT ts,amount,type FROM expenses WHERE user_id=? AND ts>=? AND ts<? ORDER BY ts", (uid, start.isoformat(), end.isoformat()))
-        expenses = await cur_e.fetchall()
-    text = f"Звіт за період {parts[0]} — {parts[1]}:\n\n"
-    text += "Доходи:\n"
-    for r in incomes:
-        text += f"- {r[0][:10]}: {r[1]:.2f}\n"
-    text += "\nВитрати:\n"
-    for r in expenses:
-        text += f"- {r[0][:10]}: {r[2]} {r[1]:.2f}\n"
-    bal = sum(r[1] for r in incomes) - sum(r[1] for r in expenses)
-    text += f"\nСальдо за період: {bal:.2f}"
-    await message.answer(text, reply_markup=main_keyboard)
+    period = (uid, to_ts(start), to_ts(end))
+    # підсумки рахує SQLite; у Python тягнемо лише рядки для показу
+    inc_total, inc_count = await fetchone(REPORT_INC_TOTAL_SQL, period)
+    exp_total, exp_count = await fetchone(REPORT_EXP_TOTAL_SQL, period)
+    cur_i = await DB.execute(REPORT_INC_ROWS_SQL, period + (REPORT_ROWS_LIMIT,))
+    incomes = await cur_i.fetchall()
+    cur_e = await DB.execute(REPORT_EXP_ROWS_SQL, period + (REPORT_ROWS_LIMIT,))
+    expenses = await cur_e.fetchall()
+    lines = [f"Звіт за період {parts[0]} — {parts[1]}:", "", "Доходи:"]
+    lines.extend(f"- {day}: {amt:.2f}" for day, amt in incomes)
+    if inc_count > len(incomes):
+        lines.append(f"... (ще {inc_count - len(incomes)})")
+    lines += ["", "Витрати:"]
+    lines.extend(f"- {day}: {type_} {amt:.2f}" for day, amt, type_ in expenses)
+    if exp_count > len(expenses):
+        lines.append(f"... (ще {exp_count - len(expenses)})")
+    bal = inc_total - exp_total
+    lines += ["", f"Сальдо за період: {bal:.2f}"]
+    await message.answer("\n".join(lines), reply_markup=main_keyboard)
+    await state.clear()
 
 # --- Мій автомобіль: перегляд та редагування (без зміни псевдоніма) ---
+MY_CAR_SQL = "SELECT name,nickname,car_model,car_number FROM users WHERE user_id=?"
+
 async def my_car_handler(message: types.Message, state: FSMContext):
     uid = message.from_user.id
-    r = await fetchone("SELECT name,nickname,car_model,car_number FROM users WHERE user_id=?", (uid,))
+    r = await fetchone(MY_CAR_SQL, (uid,))
     if not r:
         await message.answer("Ви ще не зареєстровані.")
         return
     name, nick, car_model, car_number = r
-    kb = types.InlineKeyboardMarkup(inline_keyboard=[
-        [types.InlineKeyboardButton(text="Редагувати ім'я", callback_data="edit:name")],
-        [types.InlineKeyboardButton(text="Редагувати авто", callback_data="edit:car")],
-        [types.InlineKeyboardButton(text="Закрити", callback_data="edit:close")]
-    ])
-    await message.answer(f"👤 {name}\n🏷️ {nick}\n🚘 {car_model} ({car_number})", reply_markup=kb)
+    await message.answer(f"👤 {name}\n🏷️ {nick}\n🚘 {car_model} ({car_number})", reply_markup=car_edit_keyboard)
 
 async def edit_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
@@ -346,12 +573,7 @@ async def edit_callback(callback: types.CallbackQuery, state: FSMContext):
 
 # --- Налаштування (мінімально: зміна мови/періодичності звітів) ---
 async def settings_handler(message: types.Message, state: FSMContext):
-    kb = types.InlineKeyboardMarkup(inline_keyboard=[
-        [types.InlineKeyboardButton(text="Мова: Українська", callback_data="setlang:uk")],
-        [types.InlineKeyboardButton(text="Період звітів: Щотижня", callback_data="setperiod:weekly"),
-         types.InlineKeyboardButton(text="Період звітів: Щомісяця", callback_data="setperiod:monthly")],
-    ])
-    await message.answer("Налаштування:", reply_markup=kb)
+    await message.answer("Налаштування:", reply_markup=settings_keyboard)
 
 async def settings_callback(callback: types.CallbackQuery):
     await callback.answer()
@@ -369,11 +591,10 @@ async def top_drivers_handler(message: types.Message, state: FSMContext):
     if not rows:
         await message.answer("Поки що немає даних для рейтингу.")
         return
-    text = "🏆 Топ водіїв:\n"
-    for i, r in enumerate(rows, start=1):
-        nick, name, bal = r
-        text += f"{i}. {name} ({nick}) — {bal:.2f}\n"
-    await message.answer(text, reply_markup=main_keyboard)
+    lines = ["🏆 Топ водіїв:"]
+    for i, (nick, name, bal) in enumerate(rows, start=1):
+        lines.append(f"{i}. {name} ({nick}) — {bal:.2f}")
+    await message.answer("\n".join(lines), reply_markup=main_keyboard)
 
 # --- Реєстрація хендлерів у Dispatcher ---
 dp.message.register(cmd_start, Command(commands=["start"]))
@@ -382,29 +603,70 @@ dp.message.register(process_nickname, StateFilter(Registration.waiting_for_nickn
 dp.message.register(process_car_model, StateFilter(Registration.waiting_for_car_model))
 dp.message.register(process_car_number, StateFilter(Registration.waiting_for_car_number))
 
-dp.message.register(add_income_start, lambda m: m.text == "📥 Додати заробіток")
+# Кнопки головної клавіатури: один хендлер і dict-пошук за точним текстом
+# замість ланцюжка lambda-фільтрів на кожне повідомлення
+BUTTON_HANDLERS = {
+    "📥 Додати заробіток": add_income_start,
+    "💸 Додати витрати": add_expense_start,
+    "📊 Моя статистика": my_stats_handler,
+    "📅 Звіт за період": report_period_start,
+    "🏆 Топ водіїв": top_drivers_handler,
+    "🚘 Мій автомобіль": my_car_handler,
+    "⚙️ Налаштування": settings_handler,
+}
+
+async def main_keyboard_handler(message: types.Message, state: FSMContext):
+    return await BUTTON_HANDLERS[message.text](message, state)
+
+dp.message.register(main_keyboard_handler, lambda m: m.text in BUTTON_HANDLERS)
 dp.message.register(add_income_amount, StateFilter(AddIncome.waiting_for_amount))
-dp.message.register(add_expense_start, lambda m: m.text == "💸 Додати витрати")
 dp.message.register(add_expense_amount, StateFilter(AddExpense.waiting_for_amount))
 dp.callback_query.register(exp_type_callback, lambda c: c.data and c.data.startswith("exp_type:"))
 
-dp.message.register(my_stats_handler, lambda m: m.text == "📊 Моя статистика")
-dp.message.register(report_period_handler, lambda m: "," in m.text and m.text[0].isdigit())  # простий catch для "YYYY-MM-DD,YYYY-MM-DD"
-dp.message.register(report_period_start, lambda m: m.text == "📅 Звіт за період")
+dp.message.register(report_period_handler, StateFilter(Report.waiting_for_range))
 
-dp.message.register(top_drivers_handler, lambda m: m.text == "🏆 Топ водіїв")
-dp.message.register(my_car_handler, lambda m: m.text == "🚘 Мій автомобіль")
 dp.callback_query.register(edit_callback, lambda c: c.data and c.data.startswith("edit:"))
-
-dp.message.register(settings_handler, lambda m: m.text == "⚙️ Налаштування")
 dp.callback_query.register(settings_callback, lambda c: c.data and c.data.startswith("set"))
 
 # --- Запуск ---
+# Гарячі SELECT-и виконуємо раз на старті з фіктивним user_id, щоб вони вже
+# лежали в кеші підготовлених запитів sqlite3 до першого користувача
+WARMUP_QUERIES = [
+    (STATS_SQL, (0, 0, 0, 0)),
+    (REPORT_INC_TOTAL_SQL, (0, 0, 0)),
+    (REPORT_EXP_TOTAL_SQL, (0, 0, 0)),
+    (REPORT_INC_ROWS_SQL, (0, 0, 0, 0)),
+    (REPORT_EXP_ROWS_SQL, (0, 0, 0, 0)),
+    (MY_CAR_SQL, (0,)),
+]
+
+async def warm_statements():
+    for query, params in WARMUP_QUERIES:
+        await fetchone(query, params)
+
 async def main():
+    global DB, DB_WRITE_LOCK, WRITE_Q
     await init_db()
+    DB = await aiosqlite.connect(DB_PATH)
+    DB.row_factory = aiosqlite.Row
+    await apply_pragmas(DB)
+    await load_registered()
+    await warm_statements()
+    DB_WRITE_LOCK = asyncio.Lock()
+    WRITE_Q = asyncio.Queue()
+    writer = asyncio.create_task(writer_loop())
+    writer.add_done_callback(on_writer_done)
     try:
         await dp.start_polling(bot)
     finally:
+        if not writer.done():
+            # дописуємо все, що залишилось у черзі; якщо writer впаде посеред
+            # цього, join() ніколи не завершиться — тому чекаємо на перше з двох
+            drained = asyncio.ensure_future(WRITE_Q.join())
+            await asyncio.wait({drained, writer}, return_when=asyncio.FIRST_COMPLETED)
+            drained.cancel()
+        writer.cancel()
+        await DB.close()
         await bot.session.close()
 
 if __name__ == "__main__":